@@ -1,97 +1,185 @@
 # backend/database.py
 import sqlite3
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from .models import Event
 from typing import Optional
 
 DATABASE_FILE = "/home/eborcherding/Documents/annotator/annotator/test_range.db"
 
-def init_db():
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    # Added the 'status' column with a default value
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS events (
-            id TEXT PRIMARY KEY, 
-            start_timestamp TEXT NOT NULL, 
-            end_timestamp TEXT NOT NULL, 
-            vehicle_type TEXT NOT NULL, 
-            vehicle_identifier TEXT, 
-            direction TEXT, 
-            annotator_notes TEXT,
-            status TEXT NOT NULL DEFAULT 'manual'
-        );
-    """)
-    # Add status column if it doesn't exist (for backward compatibility)
+READ_POOL_SIZE = 4  # Reader connections; writes share a single connection
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+_read_pool: Optional[queue.Queue] = None
+_read_pool_lock = threading.Lock()
+
+def _timestamp_text(dt: datetime) -> str:
+    """
+    The stored form of a timestamp: fixed-width UTC ISO 8601, so text order is time order
+    and range filters can use the start_timestamp indexes. Naive values are taken as UTC.
+    """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+def _open_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # Wait out a competing writer instead of failing with SQLITE_BUSY
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+def _get_conn() -> sqlite3.Connection:
+    """Returns the shared writer connection, opening it in WAL mode on first use. Call with _lock held."""
+    global _conn
+    if _conn is None:
+        _conn = _open_conn()
+        # WAL lets reads proceed during writes and avoids a journal fsync per commit
+        _conn.execute("PRAGMA journal_mode=WAL")
+    return _conn
+
+@contextmanager
+def _read_conn():
+    """Borrows a reader connection so queries don't queue behind writes on _lock."""
+    global _read_pool
+    if _read_pool is None:
+        with _lock:
+            _get_conn()  # Switch the file to WAL before any reader opens it
+        with _read_pool_lock:
+            if _read_pool is None:
+                pool = queue.Queue()
+                for _ in range(READ_POOL_SIZE):
+                    pool.put(_open_conn())
+                _read_pool = pool
+    conn = _read_pool.get()
     try:
-        cursor.execute("ALTER TABLE events ADD COLUMN status TEXT NOT NULL DEFAULT 'manual'")
-    except sqlite3.OperationalError:
-        pass # Column already exists
-    conn.commit()
-    conn.close()
+        yield conn
+    finally:
+        _read_pool.put(conn)
+
+def init_db():
+    with _lock:
+        conn = _get_conn()
+        cursor = conn.cursor()
+        # Added the 'status' column with a default value
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                id TEXT PRIMARY KEY,
+                start_timestamp TEXT NOT NULL,
+                end_timestamp TEXT NOT NULL,
+                vehicle_type TEXT NOT NULL,
+                vehicle_identifier TEXT,
+                direction TEXT,
+                annotator_notes TEXT,
+                status TEXT NOT NULL DEFAULT 'manual'
+            );
+        """)
+        # Add status column if it doesn't exist (for backward compatibility)
+        try:
+            cursor.execute("ALTER TABLE events ADD COLUMN status TEXT NOT NULL DEFAULT 'manual'")
+        except sqlite3.OperationalError:
+            pass # Column already exists
+        # Serve the status-filtered and unfiltered ORDER BY start_timestamp listings without a sort
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_status_start ON events(status, start_timestamp DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_start ON events(start_timestamp DESC)")
+        # Rows saved before timestamps were normalized keep whatever offset they came with
+        if cursor.execute("PRAGMA user_version").fetchone()[0] < 1:
+            rows = cursor.execute("SELECT id, start_timestamp, end_timestamp FROM events").fetchall()
+            cursor.executemany("UPDATE events SET start_timestamp = ?, end_timestamp = ? WHERE id = ?", [(
+                _timestamp_text(datetime.fromisoformat(row['start_timestamp'].replace('Z', '+00:00'))),
+                _timestamp_text(datetime.fromisoformat(row['end_timestamp'].replace('Z', '+00:00'))),
+                row['id'],
+            ) for row in rows])
+            cursor.execute("PRAGMA user_version = 1")
+        conn.commit()
 
 def save_event_to_db(event: Event):
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO events (id, start_timestamp, end_timestamp, vehicle_type, vehicle_identifier, direction, annotator_notes, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+    save_events_to_db([event])
+
+def save_events_to_db(events: list[Event]):
+    """Inserts many events in a single transaction."""
+    rows = [(
         event.id,
-        event.start_timestamp.isoformat(),
-        event.end_timestamp.isoformat(),
+        _timestamp_text(event.start_timestamp),
+        _timestamp_text(event.end_timestamp),
         event.vehicle_type,
         event.vehicle_identifier,
         event.direction,
         event.annotator_notes,
         event.status
-    ))
-    conn.commit()
-    conn.close()
+    ) for event in events]
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            conn.executemany("INSERT INTO events (id, start_timestamp, end_timestamp, vehicle_type, vehicle_identifier, direction, annotator_notes, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
 
 def get_all_events_from_db(status: Optional[str] = None) -> list[dict]:
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
     query = "SELECT * FROM events"
     params = []
-    
+
     if status:
         query += " WHERE status = ?"
         params.append(status)
-        
+
     query += " ORDER BY start_timestamp DESC"
-    
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+
+    with _read_conn() as conn:
+        rows = conn.execute(query, params).fetchall()
+    return [dict(row) for row in rows]
+
+def get_events_filtered(status: Optional[str] = None, start_date: Optional[datetime] = None, end_date: Optional[datetime] = None, vehicle_types: Optional[list[str]] = None) -> list[dict]:
+    """Fetches events matching all given filters. Dates bound start_timestamp and are compared in the stored UTC form, so offsets are honoured."""
+    clauses = []
+    params = []
+
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+    if start_date:
+        clauses.append("start_timestamp >= ?")
+        params.append(_timestamp_text(start_date))
+    if end_date:
+        clauses.append("start_timestamp <= ?")
+        params.append(_timestamp_text(end_date))
+    if vehicle_types:
+        clauses.append(f"vehicle_type IN ({', '.join('?' * len(vehicle_types))})")
+        params.extend(vehicle_types)
+
+    query = "SELECT * FROM events"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY start_timestamp DESC"
+
+    with _read_conn() as conn:
+        rows = conn.execute(query, params).fetchall()
     return [dict(row) for row in rows]
 
 def delete_event_from_db(event_id: str) -> bool:
     """Deletes an event from the database by its ID. Returns True if a row was deleted, False otherwise."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM events WHERE id = ?", (event_id,))
-    conn.commit()
-    deleted_rows = cursor.rowcount
-    conn.close()
-    return deleted_rows > 0
+    with _lock:
+        conn = _get_conn()
+        cursor = conn.execute("DELETE FROM events WHERE id = ?", (event_id,))
+        conn.commit()
+        return cursor.rowcount > 0
 
 def update_event_status_in_db(event_id: str, new_status: str) -> bool:
     """Updates the status of an event. Returns True if a row was updated, False otherwise."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE events SET status = ? WHERE id = ?", (new_status, event_id))
-    conn.commit()
-    updated_rows = cursor.rowcount
-    conn.close()
-    return updated_rows > 0
+    with _lock:
+        conn = _get_conn()
+        cursor = conn.execute("UPDATE events SET status = ? WHERE id = ?", (new_status, event_id))
+        conn.commit()
+        return cursor.rowcount > 0
 
 def get_event_by_id_from_db(event_id: str) -> dict | None:
     """Fetches a single event by its ID."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM events WHERE id = ?", (event_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with _read_conn() as conn:
+        row = conn.execute("SELECT * FROM events WHERE id = ?", (event_id,)).fetchone()
     return dict(row) if row else None
 
 # backend/database.py
\ No newline at end of file
@@ -1,37 +1,65 @@
 # backend/main.py
 import uuid
 import json
+import hashlib
+import orjson
 import os
 import asyncio
+import aiofiles
+import traceback
 from datetime import datetime, timezone
 from typing import List, Optional
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, Response, status, APIRouter, File, UploadFile, Form, BackgroundTasks, Query
-from fastapi.responses import JSONResponse
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request, Response, status, APIRouter, File, UploadFile, Form, BackgroundTasks, Query
+from fastapi.concurrency import run_in_threadpool
 
 from fastapi.middleware.cors import CORSMiddleware
 from .models import Event, EventPayload, VehicleConfig, EventStatusUpdate 
 from backend import database
 from backend import questdb_client
 
-import io
 import wave
 import struct
-from fastapi.responses import StreamingResponse
-import soundfile as sf
+from fastapi.responses import JSONResponse, StreamingResponse
 import numpy as np
 
 PROJECT_ROOT = Path(__file__).parent
+class ORJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson instead of the stdlib json module. Datetimes are written as UTC with a 'Z' suffix."""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC)
+
+# Kept off the app default: any custom default_response_class disables FastAPI's Pydantic
+# dump_json fast path for response_model routes. Routes without a model return it explicitly.
 app = FastAPI(title="Test Range Annotation API")
 app.add_middleware(CORSMiddleware, allow_origins=["http://localhost:5173"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
-TEMP_UPLOAD_DIR = PROJECT_ROOT / "data" / "uploads"
+TEMP_UPLOAD_DIR = Path(os.getenv("TEMP_UPLOAD_DIR", PROJECT_ROOT / "data" / "uploads"))
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "8"))  # Workers for blocking ingest I/O
+UPLOAD_CHUNK_SIZE = 1 << 20  # Bytes copied per read when saving uploads
+INGEST_FILE_CONCURRENCY = int(os.getenv("INGEST_FILE_CONCURRENCY", "4"))  # Files ingested at once per request
+EXPORT_CHUNK_EVENTS = 1000  # Annotations encoded per streamed export chunk
+MAX_WAVEFORM_POINTS = 50_000  # Upper bound on buckets per waveform request
+MAX_RAW_AUDIO_SECONDS = 300  # Longest clip the raw audio endpoint will return
+WAVEFORM_CACHE_CONTROL = "public, max-age=60, stale-while-revalidate=600"
 
 @app.on_event("startup")
 async def startup_event():
+    # Size the loop's default executor explicitly so concurrent ingests don't grab min(32, cpu+4) threads
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="io"))
     database.init_db()
-    os.makedirs(PROJECT_ROOT / "data" / "events", exist_ok=True)
-    os.makedirs(TEMP_UPLOAD_DIR, exist_ok=True)
+    (PROJECT_ROOT / "data" / "events").mkdir(parents=True, exist_ok=True)
+    TEMP_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        _load_vehicle_config()
+    except Exception as e:
+        print(f"WARNING: Could not load vehicles.json at startup: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Both pools are created on first use and reused across requests; release them with the app
+    await run_in_threadpool(questdb_client.close_pools)
 
 router_status = APIRouter(tags=["Status"])
 router_config = APIRouter(tags=["Configuration"])
@@ -39,29 +67,49 @@ router_events = APIRouter(tags=["Events"])
 router_audio = APIRouter(tags=["Audio & Timeseries"])
 router_export = APIRouter(tags=["Export"])
 
+VEHICLES_FILE = PROJECT_ROOT / "vehicles.json"
+
+def _load_vehicle_config() -> list:
+    """Parses vehicles.json into app.state, remembering its mtime so edits can be picked up."""
+    mtime = os.stat(VEHICLES_FILE).st_mtime_ns
+    with open(VEHICLES_FILE, "r") as f:
+        app.state.vehicles = json.load(f)
+    app.state.vehicles_mtime = mtime
+    return app.state.vehicles
+
 @router_config.get("/api/config/vehicles", response_model=List[VehicleConfig])
 async def get_vehicle_config():
+    # Serve the cached parse; re-read only when the file has changed on disk (or never loaded)
     try:
-        with open(PROJECT_ROOT / "vehicles.json", "r") as f:
-            return json.load(f)
+        vehicles = getattr(app.state, "vehicles", None)
+        if vehicles is None or os.stat(VEHICLES_FILE).st_mtime_ns != app.state.vehicles_mtime:
+            vehicles = _load_vehicle_config()
     except Exception as e:
         raise HTTPException(500, f"Error with vehicles.json: {e}")
+    return vehicles
 
 async def process_and_ingest_files(collection_name: str, filenames: List[str]):
     print(f"--- BACKGROUND TASK STARTED for collection: '{collection_name}' with {len(filenames)} files. ---")
-    successful_files, failed_files = 0, 0
-    for i, filename in enumerate(filenames, 1):
-        file_path = os.path.join(TEMP_UPLOAD_DIR, filename)
-        if not os.path.exists(file_path):
-            failed_files += 1; continue
-        try:
-            await questdb_client.ingest_wav_data_async(file_path, collection_name)
-            successful_files += 1
-        except Exception as e:
-            failed_files += 1
-        finally:
-            if os.path.exists(file_path): os.remove(file_path)
-    
+    semaphore = asyncio.Semaphore(INGEST_FILE_CONCURRENCY)
+
+    async def _ingest_one(filename: str) -> bool:
+        file_path = TEMP_UPLOAD_DIR / filename
+        async with semaphore:
+            if not await asyncio.to_thread(file_path.exists):
+                return False
+            try:
+                await questdb_client.ingest_wav_data_async(str(file_path), collection_name)
+                return True
+            except Exception as e:
+                print(f"ERROR: Ingest of '{filename}' into '{collection_name}' failed:")
+                traceback.print_exception(e)
+                return False
+            finally:
+                await asyncio.to_thread(file_path.unlink, missing_ok=True)
+
+    results = await asyncio.gather(*[_ingest_one(filename) for filename in filenames])
+    successful_files = sum(results)
+    failed_files = len(results) - successful_files
     print(f"--- BACKGROUND TASK FINISHED --- [Successful: {successful_files}, Failed: {failed_files}]")
 
 @router_audio.post("/api/audio/ingest", status_code=status.HTTP_202_ACCEPTED)
@@ -69,82 +117,151 @@ async def ingest_audio_files_optimized(background_tasks: BackgroundTasks, collec
     background_tasks.add_task(process_and_ingest_files, collection_name, filenames)
     return {"message": f"Accepted. Ingestion for {len(filenames)} files into '{collection_name}' has started."}
 
+@router_audio.post("/api/audio/ingest-streaming")
+async def ingest_audio_stream(request: Request, collection_name: str, filename: str):
+    """Ingests one PCM16 WAV sent as the raw request body, parsing it as it arrives instead of saving it first."""
+    if not filename.lower().endswith(".wav"):
+        raise HTTPException(status_code=400, detail="Invalid file type. Only .wav supported.")
+    try:
+        written = await questdb_client.ingest_wav_stream_async(request.stream(), filename, collection_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": f"Ingested '{filename}' into '{collection_name}'.", "samples": written}
+
 @router_audio.post("/api/audio/upload")
 async def upload_audio_files(files: List[UploadFile] = File(...)):
-    saved_files = []
     for file in files:
         if not file.filename.lower().endswith(".wav"):
             raise HTTPException(status_code=400, detail="Invalid file type. Only .wav supported.")
-        file_path = os.path.join(TEMP_UPLOAD_DIR, file.filename)
-        with open(file_path, "wb") as buffer:
-            buffer.write(await file.read())
-        saved_files.append(file.filename)
+
+    async def _save(file: UploadFile) -> str:
+        # Copy in bounded chunks rather than reading the whole upload into memory
+        async with aiofiles.open(TEMP_UPLOAD_DIR / file.filename, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
+        return file.filename
+
+    saved_files = await asyncio.gather(*[_save(file) for file in files])
     return {"filenames": saved_files, "message": f"Successfully uploaded {len(saved_files)} files."}
 
 @router_audio.get("/api/audio/collections", response_model=List[str])
 async def list_collections():
-    return questdb_client.get_collections()
+    return await run_in_threadpool(questdb_client.get_collections)
+
+def _etag(*parts) -> str:
+    """A strong ETag over the values a response was built from."""
+    return '"' + hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest() + '"'
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
 
 @router_audio.get("/api/audio/waveform")
-async def get_waveform_data(collection: str, start: str, end: str, points: int = 2000):
-    return questdb_client.query_waveform_data(collection, start, end, points)
+async def get_waveform_data(request: Request, collection: str, start: str, end: str, points: int = 2000):
+    points = max(1, min(points, MAX_WAVEFORM_POINTS))
+    # The view only changes when the collection does, so revalidate against its time range
+    time_range = await run_in_threadpool(questdb_client.get_collection_time_range, collection)
+    etag = _etag(collection, start, end, points, time_range, questdb_client.ingest_generation())
+    headers = {"ETag": etag, "Cache-Control": WAVEFORM_CACHE_CONTROL}
+    if _etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    data = await run_in_threadpool(questdb_client.query_waveform_data, collection, start, end, points)
+    # Plain dicts of datetimes and ints; hand them to orjson directly and skip jsonable_encoder's per-item walk
+    return ORJSONResponse(data, headers=headers)
 
 @router_status.get("/api/health")
 async def health_check(): return {"status": "ok"}
 @router_events.get("/api/events", response_model=List[Event])
-async def get_all_events(status: Optional[str] = None): return database.get_all_events_from_db(status=status)
+async def get_all_events(status: Optional[str] = None): return await run_in_threadpool(database.get_all_events_from_db, status=status)
 @router_events.post("/api/events", response_model=Event, status_code=201)
 async def create_event(payload: EventPayload):
-    event = Event(id=str(uuid.uuid4()), **payload.dict())
-    database.save_event_to_db(event)
+    event = Event(id=str(uuid.uuid4()), **payload.model_dump())
+    await run_in_threadpool(database.save_event_to_db, event)
     return event
+@router_events.post("/api/events/bulk", response_model=List[Event], status_code=201)
+async def create_events_bulk(payloads: List[EventPayload]):
+    """Creates many events in one SQLite transaction."""
+    events = [Event(id=str(uuid.uuid4()), **payload.model_dump()) for payload in payloads]
+    await run_in_threadpool(database.save_events_to_db, events)
+    return events
 @router_events.delete("/api/events/{event_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_event(event_id: str):
-    if not database.delete_event_from_db(event_id):
+    if not await run_in_threadpool(database.delete_event_from_db, event_id):
         raise HTTPException(status_code=404, detail="Event not found.")
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @router_audio.get("/api/audio/collections/{collection_name}/info")
-async def get_collection_info(collection_name: str):
-    time_range = questdb_client.get_collection_time_range(collection_name)
+async def get_collection_info(request: Request, collection_name: str):
+    time_range = await run_in_threadpool(questdb_client.get_collection_time_range, collection_name)
     if not time_range:
         raise HTTPException(status_code=404, detail=f"No data found for collection '{collection_name}'.")
-    return {"time_range": time_range}
+    # Changes with every ingest, so clients always revalidate; a match skips the body
+    headers = {"ETag": _etag(collection_name, time_range, questdb_client.ingest_generation()), "Cache-Control": "no-cache"}
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return ORJSONResponse({"time_range": time_range}, headers=headers)
+
+WAV_STREAM_CHUNK_SAMPLES = 32768  # 64 KiB of PCM16 per streamed chunk
+
+def _wav_header(num_samples: int, samplerate: int, channels: int = 1) -> bytes:
+    """The 44-byte RIFF/WAVE header for a PCM16 stream of num_samples frames."""
+    block_align = channels * 2
+    data_size = num_samples * block_align
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, samplerate, samplerate * block_align, block_align, 16,
+        b'data', data_size)
 
 @router_audio.get("/api/audio/raw")
 async def get_raw_audio_clip(collection: str, start: str, end: str):
     SAMPLE_RATE = 48000
-    np_samples = questdb_client.query_raw_audio_data(collection, start, end)
+    # Reject oversized windows before they turn into a multi-GB scan and allocation
+    try:
+        duration_seconds = (questdb_client.parse_iso_timestamp(end) - questdb_client.parse_iso_timestamp(start)).total_seconds()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start and end must be ISO 8601 timestamps.")
+    if duration_seconds > MAX_RAW_AUDIO_SECONDS:
+        raise HTTPException(status_code=400, detail=f"Requested audio clip is too long. Max is {MAX_RAW_AUDIO_SECONDS} seconds.")
+    np_samples = await run_in_threadpool(questdb_client.query_raw_audio_data, collection, start, end)
     if np_samples.size == 0:
         raise HTTPException(status_code=404, detail="No audio data found for the requested range.")
-    buffer = io.BytesIO()
-    sf.write(buffer, np_samples, samplerate=SAMPLE_RATE, format='WAV', subtype='PCM_16')
-    buffer.seek(0)
-    return StreamingResponse(buffer, media_type="audio/wav")
+    samples = np.ascontiguousarray(np_samples, dtype='<i2')
+    header = _wav_header(len(samples), SAMPLE_RATE)
+
+    # Stream the header and then the PCM buffer itself, instead of encoding a second copy into memory
+    async def _stream():
+        yield header
+        pcm = memoryview(samples).cast('B')
+        step = WAV_STREAM_CHUNK_SAMPLES * 2
+        for i in range(0, len(pcm), step):
+            yield bytes(pcm[i:i + step])
+            await asyncio.sleep(0)
+
+    return StreamingResponse(_stream(), media_type="audio/wav", headers={"Content-Length": str(len(header) + samples.nbytes)})
 
 @router_events.put("/api/events/{event_id}/status", status_code=status.HTTP_204_NO_CONTENT)
 async def update_event_status(event_id: str, payload: EventStatusUpdate):
-    if not database.update_event_status_in_db(event_id, payload.status):
+    if not await run_in_threadpool(database.update_event_status_in_db, event_id, payload.status):
         raise HTTPException(status_code=404, detail="Event not found or status could not be updated.")
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @router_events.get("/api/events/{event_id}/suggest-collection")
 async def suggest_collection_for_event(event_id: str):
-    event_dict = database.get_event_by_id_from_db(event_id)
+    event_dict = await run_in_threadpool(database.get_event_by_id_from_db, event_id)
     if not event_dict:
         raise HTTPException(status_code=404, detail="Event not found.")
     
-    event_start_time = datetime.fromisoformat(event_dict['start_timestamp'])
+    event_start_time = questdb_client.parse_iso_timestamp(event_dict['start_timestamp'])
     
-    collections = questdb_client.get_collections()
+    # All collection ranges come back from one cached query, already as datetimes
+    time_ranges = await run_in_threadpool(questdb_client.get_collection_time_ranges)
     
-    for collection in collections:
-        time_range = questdb_client.get_collection_time_range(collection)
-        if time_range:
-            range_start = datetime.fromisoformat(time_range['start'].replace("Z", "+00:00"))
-            range_end = datetime.fromisoformat(time_range['end'].replace("Z", "+00:00"))
-            if range_start <= event_start_time <= range_end:
-                return {"suggested_collection": collection}
+    for collection, (range_start, range_end) in time_ranges.items():
+        if range_start <= event_start_time <= range_end:
+            return {"suggested_collection": collection}
 
     return {"suggested_collection": None}
 
@@ -154,50 +271,54 @@ async def export_dataset(start_date: Optional[str] = None, end_date: Optional[st
     Export refined events as an ML-ready dataset in JSON format.
     Filters by date and vehicle types.
     """
-    refined_events = database.get_all_events_from_db(status='refined')
-    
-    filtered_events = []
-    for event in refined_events:
-        event_start = datetime.fromisoformat(event['start_timestamp'])
-        
-        if start_date and event_start < datetime.fromisoformat(start_date):
-            continue
-        if end_date and event_start > datetime.fromisoformat(end_date):
-            continue
-        if vehicle_types and event['vehicle_type'] not in vehicle_types:
-            continue
-        filtered_events.append(event)
+    try:
+        start_bound = questdb_client.parse_iso_timestamp(start_date) if start_date else None
+        end_bound = questdb_client.parse_iso_timestamp(end_date) if end_date else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid date filter: {e}")
+
+    # Date and vehicle filters run in SQLite rather than over every refined event
+    refined_events = await run_in_threadpool(database.get_events_filtered, 'refined', start_bound, end_bound, vehicle_types)
 
     annotations = []
-    category_stats = {}
-    for event in filtered_events:
-        start_ts = datetime.fromisoformat(event['start_timestamp'])
-        end_ts = datetime.fromisoformat(event['end_timestamp'])
+    durations = []
+    for event in refined_events:
+        start_ts = questdb_client.parse_iso_timestamp(event['start_timestamp'])
+        end_ts = questdb_client.parse_iso_timestamp(event['end_timestamp'])
         duration = (end_ts - start_ts).total_seconds()
+        durations.append(duration)
         annotations.append({
             "id": event['id'], "vehicle_type": event['vehicle_type'],
             "start_timestamp": event['start_timestamp'], "end_timestamp": event['end_timestamp'],
             "duration_seconds": round(duration, 3), "vehicle_identifier": event.get('vehicle_identifier'),
             "direction": event.get('direction'), "notes": event.get('annotator_notes')
         })
-        cat = event['vehicle_type']
-        if cat not in category_stats:
-            category_stats[cat] = {"count": 0, "total_duration": 0}
-        category_stats[cat]["count"] += 1
-        category_stats[cat]["total_duration"] += duration
 
-    for cat, data in category_stats.items():
-        avg_duration = data['total_duration'] / data['count'] if data['count'] > 0 else 0
-        category_stats[cat]['avg_duration'] = round(avg_duration, 3)
+    # Per-category counts and durations in one grouped reduction, keeping first-seen category order
+    category_stats = {}
+    if annotations:
+        cats, first_seen, inverse = np.unique([a['vehicle_type'] for a in annotations], return_index=True, return_inverse=True)
+        counts = np.bincount(inverse)
+        totals = np.bincount(inverse, weights=durations)
+        for k in np.argsort(first_seen):
+            total = float(totals[k])
+            category_stats[str(cats[k])] = {"count": int(counts[k]), "total_duration": total, "avg_duration": round(total / int(counts[k]), 3)}
 
     dataset_metadata = {
         "generated_at": datetime.now(timezone.utc).isoformat(), "total_events": len(annotations),
         "date_range": {"start": start_date, "end": end_date}, "categories": list(category_stats.keys())
     }
-    final_export = {
-        "dataset_metadata": dataset_metadata, "annotations": annotations, "category_stats": category_stats
-    }
-    return JSONResponse(content=final_export)
+
+    # Encode with orjson and stream the annotations in slices instead of building one JSON string
+    async def _stream():
+        yield b'{"dataset_metadata":' + orjson.dumps(dataset_metadata) + b',"annotations":['
+        for i in range(0, len(annotations), EXPORT_CHUNK_EVENTS):
+            chunk = orjson.dumps(annotations[i:i + EXPORT_CHUNK_EVENTS])[1:-1]
+            yield (b',' if i else b'') + chunk
+            await asyncio.sleep(0)
+        yield b'],"category_stats":' + orjson.dumps(category_stats) + b'}'
+
+    return StreamingResponse(_stream(), media_type="application/json")
 
 app.include_router(router_status)
 app.include_router(router_config)
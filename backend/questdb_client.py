@@ -1,55 +1,264 @@
 # backend/questdb_client.py
 import os
+import re
+import gzip
+import struct
 import time
-from datetime import datetime, timezone
+import atexit
+import asyncio
+import functools
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+from contextlib import aclosing, contextmanager
+from typing import NamedTuple
+from datetime import datetime, timedelta, timezone
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from questdb.ingress import Sender, IngressError, TimestampNanos
+from psycopg2.pool import ThreadedConnectionPool
+from questdb.ingress import Sender, IngressError
 import numpy as np
+import pandas as pd
 import soundfile as sf
 from fastapi import HTTPException
-from multiprocessing import Pool, cpu_count
+
+try:
+    # Optional C parser; datetime.fromisoformat is used when it isn't installed
+    from ciso8601 import parse_datetime as _ciso8601_parse
+except ImportError:
+    _ciso8601_parse = None
+import multiprocessing
+import multiprocessing.pool
+from concurrent.futures import ProcessPoolExecutor
 
 # --- Connection Details ---
 QUESTDB_HOST = os.getenv("QUESTDB_HOST", "127.0.0.1")
-ILP_PORT = 9009
+HTTP_PORT = 9000  # REST/export and ILP-over-HTTP ingestion
 PG_PORT = 8812
 PG_USER = "admin"
 PG_PASSWORD = "quest"
 PG_DBNAME = "qdb"
+PG_POOL_MIN = int(os.getenv("QUESTDB_PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("QUESTDB_PG_POOL_MAX", "16"))  # Also caps concurrent pg-wire queries
 
 # --- Performance Tuning ---
 CHUNK_SIZE = 2_000_000  # Number of samples to process in each chunk
+ILP_AUTO_FLUSH_ROWS = 75_000  # Rows per ILP-over-HTTP request; the sender flushes on its own as it goes
+ILP_AUTO_FLUSH_INTERVAL_MS = 1000
+O3_MAX_LAG = "300s"  # How long QuestDB holds out-of-order rows back before committing them
+MAX_UNCOMMITTED_ROWS = CHUNK_SIZE  # Lets one ingest chunk land in a single commit
+MAX_INFLIGHT_CHUNKS = int(os.getenv("QUESTDB_MAX_INFLIGHT_CHUNKS", "4"))  # Concurrent ILP chunk writes per file
+INGEST_PROCESSES = int(os.getenv("QUESTDB_INGEST_PROCESSES", str(MAX_INFLIGHT_CHUNKS)))  # Worker processes for chunk encoding; 0 uses threads
+METADATA_CACHE_TTL = 30  # Seconds to reuse collection lists and time ranges
+WAVEFORM_CACHE_TTL = 60  # Seconds to reuse a waveform view; ingestion clears it sooner
+WAVEFORM_CACHE_SIZE = 256  # Waveform views kept in memory
+ROLLUP_RESOLUTIONS_MS = (1, 10, 100, 1000)  # Precomputed min/max bucket widths written alongside raw samples
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 # --- Helper Functions ---
 
+def _ttl_cache(ttl_seconds: float, maxsize: int | None = None):
+    """Memoizes non-None results per argument tuple for ttl_seconds, keeping at most maxsize entries. Adds a cache_clear() method."""
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            now = time.monotonic()
+            with lock:
+                entry = cache.get(args)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            value = func(*args)
+            if value is not None:
+                with lock:
+                    cache.pop(args, None)
+                    cache[args] = (now + ttl_seconds, value)
+                    if maxsize is not None and len(cache) > maxsize:
+                        # Dicts keep insertion order, so the first key is the oldest entry
+                        del cache[next(iter(cache))]
+            return value
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+# Characters QuestDB rejects in table names; none of them can appear in a quoted identifier here
+_ILLEGAL_TABLE_CHARS_RE = re.compile(r'[?,\'"\\/:()+*%~\x00-\x1f]')
+
+@functools.lru_cache(maxsize=4096)
 def _sanitize_table_name(name: str) -> str:
     """Consistently sanitizes a collection name into a valid QuestDB table name."""
-    return name.replace('-', '_').lower()
+    return _ILLEGAL_TABLE_CHARS_RE.sub('_', name.replace('-', '_').lower())
 
+_pg_pool = None
+_pg_pool_lock = threading.Lock()
+_pg_pool_slots = threading.BoundedSemaphore(PG_POOL_MAX)
+
+def _get_pg_pool() -> ThreadedConnectionPool:
+    """Lazily creates the process-wide pool of QuestDB PostgreSQL wire protocol connections."""
+    global _pg_pool
+    with _pg_pool_lock:
+        if _pg_pool is None:
+            conn_str = f"user={PG_USER} password={PG_PASSWORD} host={QUESTDB_HOST} port={PG_PORT} dbname={PG_DBNAME}"
+            _pg_pool = ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, conn_str)
+        return _pg_pool
+
+@contextmanager
 def _get_pg_connection():
-    """Establishes a connection to QuestDB over the PostgreSQL wire protocol."""
-    conn_str = f"user={PG_USER} password={PG_PASSWORD} host={QUESTDB_HOST} port={PG_PORT} dbname={PG_DBNAME}"
-    return psycopg2.connect(conn_str)
+    """Borrows a pooled connection to QuestDB, waiting for a free slot if the pool is exhausted."""
+    pool = _get_pg_pool()
+    with _pg_pool_slots:
+        conn = pool.getconn()
+        broken = False
+        try:
+            conn.autocommit = True
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            # Don't hand a dead socket (e.g. after a QuestDB restart) to the next caller
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+_http_local = threading.local()
+
+def _get_http_connection() -> http.client.HTTPConnection:
+    """Returns this thread's keep-alive connection to QuestDB's HTTP port."""
+    conn = getattr(_http_local, "conn", None)
+    if conn is None:
+        conn = http.client.HTTPConnection(QUESTDB_HOST, HTTP_PORT, timeout=90)
+        _http_local.conn = conn
+    return conn
+
+@contextmanager
+def _export_csv(sql: str):
+    """Runs a query through QuestDB's HTTP /exp endpoint and yields the CSV response stream."""
+    path = "/exp?" + urllib.parse.urlencode({"query": sql})
+    conn = _get_http_connection()
+    for attempt in range(2):
+        reused = conn.sock is not None
+        try:
+            conn.request("GET", path, headers={"Accept-Encoding": "gzip"})
+            response = conn.getresponse()
+            break
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            # Reconnect once only for an idle keep-alive socket the server dropped (RemoteDisconnected
+            # is a ConnectionResetError); after a timeout the query is just slow and would run twice
+            stale = reused and isinstance(e, (BrokenPipeError, ConnectionResetError, ConnectionAbortedError))
+            if attempt or not stale:
+                raise urllib.error.URLError(e)
+    try:
+        if response.status != 200:
+            raise urllib.error.HTTPError(path, response.status, response.reason, response.headers, None)
+        if response.getheader("Content-Encoding") == "gzip":
+            yield gzip.GzipFile(fileobj=response)
+        else:
+            yield response
+    finally:
+        # Readers may stop at the end of the body without seeing EOF; a leftover
+        # unread body would corrupt the next request on this socket
+        if not response.isclosed() and response.read(1):
+            conn.close()
+
+def _rollup_table_name(table_name: str, resolution_ms: int) -> str:
+    """Name of the table holding a collection's precomputed min/max buckets of resolution_ms."""
+    return f"{table_name}__rollup_{resolution_ms}ms"
+
+_ensured_tables: set[str] = set()
+_table_setup_locks: dict[str, threading.Lock] = {}
+_table_setup_locks_lock = threading.Lock()
 
 def _ensure_table_exists(table_name: str):
-    """Creates and optimally configures a QuestDB table if it doesn't already exist."""
+    """Creates and optimally configures a QuestDB table (and its rollup tables) if it doesn't already exist."""
     sanitized_table_name = _sanitize_table_name(table_name)
+    # The DDL is idempotent, so one successful run per process is enough
+    if sanitized_table_name in _ensured_tables:
+        return sanitized_table_name
+    with _table_setup_locks_lock:
+        lock = _table_setup_locks.setdefault(sanitized_table_name, threading.Lock())
+    # Concurrent first ingests into one collection wait here, so only one decides to backfill
+    with lock:
+        if sanitized_table_name not in _ensured_tables:
+            _setup_tables(sanitized_table_name)
+            _ensured_tables.add(sanitized_table_name)
+    return sanitized_table_name
+
+def _setup_tables(sanitized_table_name: str):
     create_sql = f"""
     CREATE TABLE IF NOT EXISTS "{sanitized_table_name}" (
         amplitude SHORT,
-        file SYMBOL,
+        file SYMBOL CAPACITY 4096 NOCACHE,
         ts TIMESTAMP
-    ) timestamp(ts) PARTITION BY HOUR;
+    ) timestamp(ts) PARTITION BY HOUR WAL
+    DEDUP UPSERT KEYS(ts, file);
     """
+    rollup_sqls = [f"""
+    CREATE TABLE IF NOT EXISTS "{_rollup_table_name(sanitized_table_name, resolution_ms)}" (
+        lo SHORT,
+        hi SHORT,
+        file SYMBOL CAPACITY 4096 NOCACHE,
+        ts TIMESTAMP
+    ) timestamp(ts) PARTITION BY DAY WAL
+    DEDUP UPSERT KEYS(ts, file);
+    """ for resolution_ms in ROLLUP_RESOLUTIONS_MS]
+    # A rollup added after the raw table already holds data must start out covering it,
+    # otherwise waveform reads would trust a rollup that is missing the older files
+    backfill_sqls = [f"""
+    INSERT INTO "{_rollup_table_name(sanitized_table_name, resolution_ms)}" (lo, hi, file, ts)
+    SELECT cast(min(amplitude) AS SHORT) lo, cast(max(amplitude) AS SHORT) hi, file, ts
+    FROM "{sanitized_table_name}"
+    SAMPLE BY {resolution_ms}T;
+    """ for resolution_ms in ROLLUP_RESOLUTIONS_MS]
+    # CREATE TABLE IF NOT EXISTS leaves older tables as they were, so dedup is switched on separately
+    dedup_sql = 'ALTER TABLE "{table}" DEDUP ENABLE UPSERT KEYS(ts, file);'
+    tuning_sqls = [
+        f'ALTER TABLE "{sanitized_table_name}" SET PARAM maxUncommittedRows = {MAX_UNCOMMITTED_ROWS};',
+        f'ALTER TABLE "{sanitized_table_name}" SET PARAM o3MaxLag = {O3_MAX_LAG};',
+    ]
     try:
         with _get_pg_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT table_name, walEnabled FROM tables()")
+            existing = dict(cur.fetchall())
             cur.execute(create_sql)
-        return sanitized_table_name
+            for resolution_ms, rollup_sql, backfill_sql in zip(ROLLUP_RESOLUTIONS_MS, rollup_sqls, backfill_sqls):
+                rollup_table = _rollup_table_name(sanitized_table_name, resolution_ms)
+                cur.execute(rollup_sql)
+                if sanitized_table_name in existing and rollup_table not in existing:
+                    # Dedup makes a second process racing this one rewrite the same buckets harmlessly
+                    print(f"Backfilling rollup table '{rollup_table}' from existing samples...")
+                    cur.execute(backfill_sql)
+            tables = [sanitized_table_name] + [_rollup_table_name(sanitized_table_name, r) for r in ROLLUP_RESOLUTIONS_MS]
+            for table in tables:
+                if table not in existing:
+                    continue  # Created above with dedup already on
+                if existing[table]:
+                    cur.execute(dedup_sql.format(table=table))
+                else:
+                    print(f"Warning: table '{table}' is not a WAL table, so re-ingesting a file into it will duplicate rows")
+            # Also brings tables created before these settings in line
+            for tuning_sql in tuning_sqls:
+                try:
+                    cur.execute(tuning_sql)
+                except psycopg2.Error as e:
+                    print(f"Warning: could not tune table '{sanitized_table_name}': {e}")
     except Exception as e:
         print(f"Error creating/configuring table '{sanitized_table_name}': {e}")
         raise
 
+def parse_iso_timestamp(value: str) -> datetime:
+    """Parses an ISO 8601 timestamp, accepting a 'Z' suffix. Raises ValueError if malformed."""
+    if _ciso8601_parse is not None:
+        return _ciso8601_parse(value)
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
 def _to_utc_iso(dt: datetime) -> str:
     """
     Ensures a datetime object is timezone-aware (as UTC) and formats it
@@ -59,73 +268,477 @@ def _to_utc_iso(dt: datetime) -> str:
         dt = dt.replace(tzinfo=timezone.utc)
     return dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
 
+def _as_utc(dt: datetime) -> datetime:
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc)
+
+def _sql_timestamp(value: str) -> str:
+    """Normalizes an ISO 8601 string to a UTC microsecond literal that is safe to embed in SQL. Raises ValueError if unparseable."""
+    return _as_utc(parse_iso_timestamp(value)).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def downsample_min_max(samples: np.ndarray, timestamps_ns: np.ndarray, bucket_ns: int):
+    """
+    Reduces time-ordered samples to per-bucket (bucket_start_ns, min, max) arrays.
+    Buckets are aligned to the epoch, and each aggregate is a single reduceat pass in NumPy.
+    """
+    if len(samples) == 0:
+        return np.empty(0, dtype=np.int64), samples[:0], samples[:0]
+    bucket_ids = timestamps_ns // bucket_ns
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket_ids)) + 1))
+    return (
+        bucket_ids[starts] * bucket_ns,
+        np.minimum.reduceat(samples, starts),
+        np.maximum.reduceat(samples, starts),
+    )
+
 # --- CRITICAL FIX: Ensure parsed timestamps are timezone-aware ---
+_FILENAME_TS_RE = re.compile(r'(?:^|_)(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})$')
+
+@functools.lru_cache(maxsize=4096)
 def parse_filename_for_timestamp(filename: str) -> datetime | None:
     """Parses a filename like '..._YYYYMMDD_HHMMSS.WAV' into a UTC datetime object."""
+    # splitext, not the regex, decides what the extension is, exactly as the original parser did
+    stem = os.path.splitext(filename)[0]
+    match = _FILENAME_TS_RE.search(stem)
+    if match is not None:
+        try:
+            # Build the datetime directly; strptime re-parses its format string on every call
+            return datetime(*map(int, match.groups()), tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    # Anything else (e.g. unpadded fields like '2025623') goes through the original strptime parse
     try:
-        parts = os.path.splitext(filename)[0].split('_')
-        timestamp_str = f"{parts[-2]}_{parts[-1]}"
-        # Create a naive datetime and then make it explicitly UTC
-        naive_dt = datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
+        parts = stem.split('_')
+        naive_dt = datetime.strptime(f"{parts[-2]}_{parts[-1]}", "%Y%m%d_%H%M%S")
         return naive_dt.replace(tzinfo=timezone.utc)
     except (IndexError, ValueError):
         return None
 
 # --- Ingestion Pipeline ---
 
+def _file_symbol(filename: str, n: int) -> pd.Categorical:
+    """A constant symbol column of length n, encoded once as a categorical."""
+    return pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), categories=[filename])
+
+class _FileChunk(NamedTuple):
+    """A chunk-sized frame range of a file on disk, read by the worker instead of pickled to it."""
+    filepath: str
+    offset: int
+    frames: int
+    start_ns: int
+    samplerate: int
+
+def _chunk_frames(samplerate: int) -> int:
+    """
+    Frames per ingest chunk: CHUNK_SIZE rounded down to whole seconds of audio. Recordings
+    start on a whole second, so no rollup bucket straddles two chunks and each is written once.
+    """
+    return max(1, CHUNK_SIZE // samplerate) * samplerate
+
+_worker_local = threading.local()
+
+def _get_worker_sender() -> Sender:
+    """This worker's ILP sender, opened on first use and kept across chunks so its HTTP connections are reused."""
+    sender = getattr(_worker_local, 'sender', None)
+    # A forked child inherits the parent's thread-local state; never share its connections
+    if sender is None or _worker_local.pid != os.getpid():
+        conf = (f"http::addr={QUESTDB_HOST}:{HTTP_PORT};"
+                f"auto_flush_rows={ILP_AUTO_FLUSH_ROWS};auto_flush_interval={ILP_AUTO_FLUSH_INTERVAL_MS};")
+        sender = Sender.from_conf(conf)
+        sender.establish()
+        _worker_local.sender, _worker_local.pid = sender, os.getpid()
+    return sender
+
+def _discard_worker_sender():
+    """Drops this worker's sender after a failure, along with any rows still buffered in it."""
+    sender = getattr(_worker_local, 'sender', None)
+    _worker_local.sender = None
+    if sender is not None:
+        try:
+            sender.close(flush=False)
+        except IngressError:
+            pass
+
 def ingest_worker(task_args):
     """The top-level worker function for multiprocessing."""
     worker_id, chunk_data, table_name, filename = task_args
+    if isinstance(chunk_data, _FileChunk):
+        chunk_data = _read_file_chunk(chunk_data)
     samples, timestamps = chunk_data
     try:
-        conf = f"tcp::addr={QUESTDB_HOST}:{ILP_PORT};"
-        with Sender.from_conf(conf) as sender:
-            for sample, ts in zip(samples, timestamps, strict=True):
-                sender.row(
-                    table_name,
-                    symbols={'file': filename},
-                    columns={'amplitude': int(sample)},
-                    at=TimestampNanos(int(ts)))
-            sender.flush()
+        # Build the whole chunk as one frame so the ILP encoding happens in the
+        # client's native code rather than one Python call per sample.
+        df = pd.DataFrame({
+            'amplitude': samples,
+            'file': _file_symbol(filename, len(samples)),
+            'ts': pd.to_datetime(timestamps, unit='ns', utc=True),
+        })
+        sender = _get_worker_sender()
+        sender.dataframe(df, table_name=table_name, symbols=['file'], at='ts')
+        for resolution_ms in ROLLUP_RESOLUTIONS_MS:
+            bucket_ts, lo, hi = downsample_min_max(samples, timestamps, resolution_ms * 1_000_000)
+            rollup_df = pd.DataFrame({
+                'lo': lo,
+                'hi': hi,
+                'file': _file_symbol(filename, len(bucket_ts)),
+                'ts': pd.to_datetime(bucket_ts, unit='ns', utc=True),
+            })
+            sender.dataframe(rollup_df, table_name=_rollup_table_name(table_name, resolution_ms), symbols=['file'], at='ts')
+        # Flush the tail before reporting the chunk written; the sender itself stays open
+        sender.flush()
         return len(samples)
     except IngressError as e:
         print(f"!! [Worker {worker_id}] Ingress Error: {e}")
-        return 0
+        _discard_worker_sender()
+        # Auto-flush may already have committed part of the chunk; the file must not count as ingested.
+        # IngressError can't be unpickled, so re-raise as a type that survives the trip back from a worker process.
+        raise RuntimeError(f"ILP write of chunk {worker_id} of '{filename}' to '{table_name}' failed: {e}") from e
 
-def prepare_ingestion_tasks(filepath: str, collection_name: str):
-    """Reads an audio file and prepares a list of tasks for the multiprocessing pool."""
-    filename = os.path.basename(filepath)
-    sanitized_table_name = _ensure_table_exists(collection_name)
-    
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """Lazily starts the shared worker processes that run ingest_worker off the GIL."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn: forking a process that holds pool threads and sockets is unsafe
+            _process_pool = ProcessPoolExecutor(max_workers=INGEST_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+def close_pools():
+    """Closes pooled QuestDB connections and stops the ingest worker processes. Safe to call repeatedly."""
+    global _pg_pool, _process_pool
+    with _pg_pool_lock:
+        if _pg_pool is not None:
+            _pg_pool.closeall()
+            _pg_pool = None
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown()
+            _process_pool = None
+
+atexit.register(close_pools)
+
+def _map_pcm16_wav(filepath: str) -> tuple[np.ndarray, int] | None:
+    """
+    Memory-maps the data chunk of a plain 16-bit PCM WAV as a (frames, channels) int16
+    array, returning it with the sample rate. Returns None for any other format.
+    """
+    with open(filepath, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12:
+            return None
+        riff, _, wave_id = struct.unpack('<4sI4s', header)
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            return None
+        fmt = None
+        while len(header := f.read(8)) == 8:
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                body = f.read(size + (size & 1))
+                if len(body) < 16:
+                    return None  # Malformed or truncated; left to soundfile to report
+                tag, channels, samplerate, _, _, bits = struct.unpack('<HHIIHH', body[:16])
+                if tag == 0xFFFE and size >= 26:
+                    tag = struct.unpack('<H', body[24:26])[0]  # WAVE_FORMAT_EXTENSIBLE subformat
+                fmt = (tag, channels, samplerate, bits)
+            elif chunk_id == b'data':
+                if fmt is None or fmt[0] != 1 or fmt[3] != 16:
+                    return None
+                _, channels, samplerate, _ = fmt
+                data_offset = f.tell()
+                # Streaming writers may leave the size unset; never map past the end of the file
+                size = min(size, os.fstat(f.fileno()).st_size - data_offset)
+                frames = size // (2 * channels)
+                if frames == 0:
+                    return np.empty((0, channels), dtype=np.int16), samplerate
+                pcm = np.memmap(filepath, dtype='<i2', mode='r', offset=data_offset, shape=(frames, channels))
+                return pcm, samplerate
+            else:
+                f.seek(size + (size & 1), 1)
+    return None
+
+def _audio_info(filepath: str) -> tuple[int, int]:
+    """Returns the (sample rate, frame count) of an audio file."""
+    mapped = _map_pcm16_wav(filepath)
+    if mapped is not None:
+        pcm, samplerate = mapped
+        return samplerate, len(pcm)
+    info = sf.info(filepath)
+    return info.samplerate, info.frames
+
+def _read_frames(filepath: str, offset: int, frames: int) -> np.ndarray:
+    """Reads a (frames, channels) int16 block starting at frame `offset`."""
+    mapped = _map_pcm16_wav(filepath)
+    if mapped is not None:
+        # PCM16 needs no decoding: slice the mapping and let the OS page data in on demand
+        return mapped[0][offset:offset + frames]
+    return sf.read(filepath, frames=frames, start=offset, dtype='int16', always_2d=True)[0]
+
+def _filename_start_ns(filename: str) -> int:
+    """Recording start encoded in the filename, as integer ns since the epoch."""
     start_timestamp = parse_filename_for_timestamp(filename)
     if not start_timestamp:
         raise ValueError(f"Could not parse timestamp from filename: {filename}")
+    return (start_timestamp - _EPOCH) // timedelta(microseconds=1) * 1_000
 
-    audio_data, samplerate = sf.read(filepath, dtype='int16', always_2d=False)
-    total_points = len(audio_data)
+def _chunk_arrays(block: np.ndarray, offset: int, start_ns: int, samplerate: int):
+    """Turns a (frames, channels) block starting at frame `offset` into mono samples and ns timestamps."""
+    if block.shape[1] > 1:
+        # Multi-channel recording: store the mono downmix
+        chunk_samples = block.mean(axis=1).astype(np.int16)
+    else:
+        chunk_samples = np.asarray(block[:, 0])
+    # Integer-only: no float64 temporary and no rounding drift over long files.
+    # Rounded to the nearest ns for rates like 44.1 kHz that don't divide 1e9.
+    sample_indices = np.arange(offset, offset + len(chunk_samples), dtype=np.int64)
+    chunk_timestamps = start_ns + (sample_indices * 1_000_000_000 + samplerate // 2) // samplerate
+    return chunk_samples, chunk_timestamps
 
-    start_ns = int(start_timestamp.timestamp() * 1_000_000_000)
-    ns_per_sample = 1_000_000_000 / samplerate
-    timestamps_ns = start_ns + (np.arange(total_points) * ns_per_sample).astype(np.int64)
+def _read_file_chunk(chunk: _FileChunk):
+    block = _read_frames(chunk.filepath, chunk.offset, chunk.frames)
+    return _chunk_arrays(block, chunk.offset, chunk.start_ns, chunk.samplerate)
 
-    tasks = []
-    for i, start_idx in enumerate(range(0, total_points, CHUNK_SIZE)):
-        end_idx = start_idx + CHUNK_SIZE
-        chunk_samples = audio_data[start_idx:end_idx]
-        chunk_timestamps = timestamps_ns[start_idx:end_idx]
-        tasks.append((i + 1, (chunk_samples, chunk_timestamps), sanitized_table_name, filename))
-    
-    return tasks
+def _ingestion_task(chunk_id: int, block: np.ndarray, offset: int, start_ns: int, samplerate: int, table_name: str, filename: str):
+    """Builds an ingest_worker task from a (frames, channels) block starting at frame `offset`."""
+    return (chunk_id, _chunk_arrays(block, offset, start_ns, samplerate), table_name, filename)
+
+def iter_ingestion_tasks(filepath: str, collection_name: str):
+    """
+    Yields one ingest_worker task per _chunk_frames() frames of an audio file. Tasks only
+    name a frame range, so workers read the samples themselves and nothing large is pickled.
+    """
+    filename = os.path.basename(filepath)
+    sanitized_table_name = _ensure_table_exists(collection_name)
+    start_ns = _filename_start_ns(filename)
+
+    samplerate, frames = _audio_info(filepath)
+    chunk_frames = _chunk_frames(samplerate)
+    for i, offset in enumerate(range(0, frames, chunk_frames)):
+        chunk = _FileChunk(filepath, offset, min(chunk_frames, frames - offset), start_ns, samplerate)
+        yield (i + 1, chunk, sanitized_table_name, filename)
+
+def create_ingest_pool(processes: int | None = None) -> multiprocessing.pool.Pool:
+    """A multiprocessing Pool for ingest_file_multiprocess; scripts ingesting many files should create one and reuse it."""
+    return multiprocessing.Pool(processes=processes or max(1, os.cpu_count() - 1))
+
+def ingest_file_multiprocess(filepath: str, collection_name: str, processes: int | None = None, pool: multiprocessing.pool.Pool | None = None) -> int:
+    """Ingests a file from a standalone script, spreading its chunks over a multiprocessing Pool (a fresh one unless given)."""
+    if pool is None:
+        with create_ingest_pool(processes) as own_pool:
+            return ingest_file_multiprocess(filepath, collection_name, pool=own_pool)
+    # Feed tasks lazily and count chunks as they finish, in whatever order
+    tasks = iter_ingestion_tasks(filepath, collection_name)
+    return sum(pool.imap_unordered(ingest_worker, tasks, chunksize=1))
+
+def _ingest_worker_by_file(task_args):
+    """ingest_worker for ingest_files_multiprocess: tags the result with its filename and contains per-chunk failures."""
+    try:
+        return task_args[3], ingest_worker(task_args), True
+    except Exception as e:
+        print(f"!! [Worker {task_args[0]}] Failed on {task_args[3]}: {e}")
+        return task_args[3], 0, False
+
+def ingest_files_multiprocess(filepaths: list[str], collection_name: str, pool: multiprocessing.pool.Pool) -> tuple[dict[str, int], set[str]]:
+    """
+    Ingests many files through one Pool as a single task stream, so the next file's chunks
+    start while the last ones are still being written. Returns points written per filename,
+    and the filenames that failed: couldn't be opened, or lost at least one chunk.
+    """
+    failed = set()
+
+    def _tasks():
+        for filepath in filepaths:
+            try:
+                yield from iter_ingestion_tasks(filepath, collection_name)
+            except Exception as e:
+                print(f"!! Skipping {os.path.basename(filepath)}: {e}")
+                failed.add(os.path.basename(filepath))
+
+    written = dict.fromkeys((os.path.basename(filepath) for filepath in filepaths), 0)
+    for filename, count, ok in pool.imap_unordered(_ingest_worker_by_file, _tasks(), chunksize=1):
+        written[filename] += count
+        if not ok:
+            failed.add(filename)
+    return written, failed
+
+_ingest_generation = 0
+
+def ingest_generation() -> int:
+    """Counts ingests completed by this process, for validators that must change when data does."""
+    return _ingest_generation
+
+async def _write_ingestion_tasks(task_source) -> int:
+    """
+    Writes the tasks of an async iterator to QuestDB. The source is pulled into a bounded
+    queue while MAX_INFLIGHT_CHUNKS consumers write, so producing overlaps the writes.
+    Chunk encoding is CPU-bound, so consumers run it in worker processes when enabled.
+    """
+    loop = asyncio.get_running_loop()
+    # One decoded chunk of lookahead is enough to keep the writers busy
+    queue = asyncio.Queue(maxsize=1)
+    errors = []
+
+    async def _consume():
+        written = 0
+        while (task := await queue.get()) is not None:
+            if errors:
+                continue  # Keep draining after a failure so the producer never blocks
+            try:
+                if INGEST_PROCESSES > 0:
+                    written += await loop.run_in_executor(_get_process_pool(), ingest_worker, task)
+                else:
+                    written += await asyncio.to_thread(ingest_worker, task)
+            except Exception as e:
+                errors.append(e)
+        return written
+
+    consumers = [asyncio.create_task(_consume()) for _ in range(MAX_INFLIGHT_CHUNKS)]
+    try:
+        async with aclosing(task_source) as tasks:
+            async for task in tasks:
+                if errors:
+                    break
+                await queue.put(task)
+    finally:
+        for _ in consumers:
+            await queue.put(None)
+        results = await asyncio.gather(*consumers)
+    if errors:
+        raise errors[0]
+
+    # New data changes the collection list and time ranges
+    get_collections.cache_clear()
+    get_collection_time_range.cache_clear()
+    get_collection_time_ranges.cache_clear()
+    _query_waveform_cached.cache_clear()
+    _rollup_covers_raw.cache_clear()
+    global _ingest_generation
+    _ingest_generation += 1
+    return sum(results)
+
+async def ingest_wav_data_async(filepath: str, collection_name: str) -> int:
+    """Streams a WAV file from disk into QuestDB, decoding chunks off the event loop."""
+    tasks = iter_ingestion_tasks(filepath, collection_name)
+
+    async def _decoded():
+        loop = asyncio.get_running_loop()
+        pending = None
+        try:
+            while True:
+                pending = loop.run_in_executor(None, next, tasks, None)
+                # Shielded so a cancellation leaves `pending` tracking the thread still inside the generator
+                task = await asyncio.shield(pending)
+                if task is None:
+                    break
+                yield task
+        finally:
+            if pending is not None and not pending.done():
+                # A generator can't be closed while another thread is executing it
+                await asyncio.wait([pending])
+            try:
+                tasks.close()
+            except ValueError:
+                pass  # Cancelled again mid-wait; the generator is finalized once that next() returns
+
+    return await _write_ingestion_tasks(_decoded())
+
+async def _iter_pcm16_stream_blocks(stream):
+    """
+    Parses a 16-bit PCM WAV arriving as an async stream of byte chunks. Yields the
+    sample rate first, then (frames, channels) int16 blocks of up to _chunk_frames() frames.
+    """
+    chunks = stream.__aiter__()
+    buf = bytearray()
+    eof = False
+
+    async def _fill(n: int) -> bool:
+        nonlocal eof
+        while len(buf) < n and not eof:
+            chunk = await anext(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                buf.extend(chunk)
+        return len(buf) >= n
+
+    if not await _fill(12) or buf[:4] != b'RIFF' or buf[8:12] != b'WAVE':
+        raise ValueError("Not a RIFF/WAVE stream")
+    del buf[:12]
+    fmt = None
+    while True:
+        if not await _fill(8):
+            raise ValueError("WAV stream ended before the data chunk")
+        chunk_id, size = struct.unpack('<4sI', buf[:8])
+        del buf[:8]
+        if chunk_id == b'data':
+            break
+        padded = size + (size & 1)
+        if not await _fill(padded):
+            raise ValueError("Truncated WAV header")
+        if chunk_id == b'fmt ':
+            if size < 16:
+                raise ValueError("Malformed WAV fmt chunk")
+            tag, channels, samplerate, _, _, bits = struct.unpack('<HHIIHH', buf[:16])
+            if tag == 0xFFFE and size >= 26:
+                tag = struct.unpack('<H', buf[24:26])[0]  # WAVE_FORMAT_EXTENSIBLE subformat
+            fmt = (tag, channels, samplerate, bits)
+        del buf[:padded]
+    if fmt is None or fmt[0] != 1 or fmt[3] != 16:
+        raise ValueError("Only 16-bit PCM WAV can be ingested as a stream")
+    _, channels, samplerate, _ = fmt
+    yield samplerate
+
+    frame_bytes = 2 * channels
+    block_bytes = _chunk_frames(samplerate) * frame_bytes
+    # Streaming writers may leave the data size unset (0 or 0xFFFFFFFF); then read to EOF
+    remaining = size if 0 < size < 0xFFFFFFFF else None
+    while remaining is None or remaining > 0:
+        want = block_bytes if remaining is None else min(block_bytes, remaining)
+        await _fill(want)
+        take = min(want, len(buf)) // frame_bytes * frame_bytes
+        if take == 0:
+            break
+        block = np.frombuffer(bytes(buf[:take]), dtype='<i2').reshape(-1, channels)
+        del buf[:take]
+        if remaining is not None:
+            remaining -= take
+        yield block
+
+async def ingest_wav_stream_async(stream, filename: str, collection_name: str) -> int:
+    """
+    Ingests a 16-bit PCM WAV straight from an async byte stream (e.g. a request body),
+    without writing it to disk. `filename` supplies the recording start timestamp.
+    """
+    start_ns = _filename_start_ns(filename)
+    sanitized_table_name = await asyncio.to_thread(_ensure_table_exists, collection_name)
+
+    async def _tasks():
+        blocks = _iter_pcm16_stream_blocks(stream)
+        async with aclosing(blocks):
+            samplerate = await anext(blocks)
+            offset = 0
+            chunk_id = 0
+            async for block in blocks:
+                chunk_id += 1
+                yield _ingestion_task(chunk_id, block, offset, start_ns, samplerate, sanitized_table_name, filename)
+                offset += len(block)
+
+    return await _write_ingestion_tasks(_tasks())
 
 # --- Data Query Functions ---
 
+@_ttl_cache(METADATA_CACHE_TTL)
 def get_collections() -> list[str]:
     """Lists all user-created tables in QuestDB."""
-    sql = "SELECT table_name FROM tables() WHERE table_name NOT LIKE 'telemetry%'"
+    # All filtering happens server-side; system tables (sys.telemetry_wal, ...) aren't collections either
+    sql = ("SELECT table_name FROM tables() WHERE table_name NOT LIKE 'telemetry%' "
+           "AND table_name NOT LIKE 'sys.%' AND table_name !~ '__rollup_[0-9]+ms$'")
     with _get_pg_connection() as conn, conn.cursor() as cur:
         cur.execute(sql)
         return [row[0] for row in cur.fetchall()]
 
+@_ttl_cache(METADATA_CACHE_TTL)
 def get_collection_time_range(collection: str) -> dict | None:
     """Gets the first and last timestamp for a given table, formatted as UTC ISO strings."""
     sql = f'SELECT min(ts), max(ts) FROM "{_sanitize_table_name(collection)}";'
@@ -141,56 +754,108 @@ def get_collection_time_range(collection: str) -> dict | None:
         print(f"Database query for time range failed: {e}")
         return None
 
+
+@_ttl_cache(METADATA_CACHE_TTL)
+def get_collection_time_ranges() -> dict:
+    """Maps every collection to its (first, last) timestamp as UTC datetimes, in one round-trip."""
+    collections = get_collections()
+    if not collections:
+        return {}
+    sql = " UNION ALL ".join(
+        "SELECT '{}' AS name, min(ts) AS first_ts, max(ts) AS last_ts FROM \"{}\"".format(c.replace("'", "''"), c)
+        for c in collections
+    )
+    try:
+        with _get_pg_connection() as conn, conn.cursor() as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+        return {name: (_as_utc(first), _as_utc(last)) for name, first, last in rows if first is not None}
+    except psycopg2.Error as e:
+        # One unreadable table fails the whole UNION; fall back to per-collection lookups
+        print(f"Combined time range query failed, querying collections one by one: {e}")
+    ranges = {}
+    for c in collections:
+        time_range = get_collection_time_range(c)
+        if time_range:
+            ranges[c] = (
+                parse_iso_timestamp(time_range['start']),
+                parse_iso_timestamp(time_range['end']),
+            )
+    return ranges
+
 def query_waveform_data(collection: str, start: str, end: str, points: int) -> list:
     """Queries aggregated waveform data (min/max) from QuestDB."""
-    start_dt = datetime.fromisoformat(start.replace("Z", "+00:00"))
-    end_dt   = datetime.fromisoformat(end.replace("Z", "+00:00"))
+    start_dt = parse_iso_timestamp(start)
+    end_dt   = parse_iso_timestamp(end)
     duration_seconds = (end_dt - start_dt).total_seconds()
     if duration_seconds <= 0: 
         return []
 
     interval_ms = max(1, int(duration_seconds * 1000 / points))
-    
-    sql = f"""
-        SELECT ts, min(amplitude), max(amplitude)
-        FROM "{_sanitize_table_name(collection)}"
-        WHERE ts BETWEEN '{start}' AND '{end}'
-        SAMPLE BY {interval_ms}T
+    return _query_waveform_cached(_sanitize_table_name(collection), start, end, interval_ms)
+
+@_ttl_cache(METADATA_CACHE_TTL)
+def _rollup_covers_raw(table_name: str, resolution_ms: int) -> bool:
+    """True if the rollup spans the raw table's whole time range, so reading it can't miss raw-only files."""
+    try:
+        with _get_pg_connection() as conn, conn.cursor() as cur:
+            cur.execute(f'SELECT min(ts), max(ts) FROM "{table_name}"')
+            raw_first, raw_last = cur.fetchone()
+            cur.execute(f'SELECT min(ts), max(ts) FROM "{_rollup_table_name(table_name, resolution_ms)}"')
+            first, last = cur.fetchone()
+    except psycopg2.Error:
+        return False  # No rollup table: collections from before rollups existed
+    if raw_first is None or first is None:
+        return False
+    # Buckets start at or before their first sample, so a covering rollup never starts later
+    return first <= raw_first and last + timedelta(milliseconds=resolution_ms) > raw_last
+
+@_ttl_cache(WAVEFORM_CACHE_TTL, maxsize=WAVEFORM_CACHE_SIZE)
+def _query_waveform_cached(table_name: str, start: str, end: str, interval_ms: int) -> list:
+    """Runs the min/max aggregation for one view. Repeat zooms and scrolls are served from the cache."""
+    # Empty buckets are dropped in SQL so rows come back ready to serialize
+    sql = """
+        SELECT ts, mn, mx FROM (
+            SELECT ts, min({lo}) mn, max({hi}) mx
+            FROM "{table}"
+            WHERE ts BETWEEN %s AND %s
+            SAMPLE BY {interval_ms}T
+        ) WHERE mn IS NOT NULL AND mx IS NOT NULL
     """
+    params = (start, end)
+    # Read from the coarsest rollup whose buckets tile the requested interval exactly and that
+    # covers every raw sample; otherwise aggregate the raw table itself
+    rollup_ms = next((r for r in sorted(ROLLUP_RESOLUTIONS_MS, reverse=True)
+                      if interval_ms % r == 0 and _rollup_covers_raw(table_name, r)), None)
     with _get_pg_connection() as conn, conn.cursor() as cur:
-        cur.execute(sql)
+        if rollup_ms is not None:
+            cur.execute(sql.format(lo="lo", hi="hi", table=_rollup_table_name(table_name, rollup_ms), interval_ms=interval_ms), params)
+        else:
+            cur.execute(sql.format(lo="amplitude", hi="amplitude", table=table_name, interval_ms=interval_ms), params)
         rows = cur.fetchall()
-        # Use the helper to ensure clean 'Z' formatted UTC strings are returned
-        data = [
-            {
-                "time": _to_utc_iso(r[0]),
-                "min": int(r[1]),
-                "max": int(r[2]),
-            }
-            for r in rows
-            if r[1] is not None and r[2] is not None
-        ]
-        return data
+        # Timestamps stay datetimes; the API's orjson response writes them as 'Z' UTC strings
+        return [{"time": r[0], "min": r[1], "max": r[2]} for r in rows]
 
 def query_raw_audio_data(collection: str, start: str, end: str) -> np.ndarray:
     """Fetches raw audio samples for playback."""
     
-    # --- START OF THE FIX ---
-    # The SQL query is modified to remove the to_timestamp() calls.
-    # We will let QuestDB perform its own string-to-timestamp casting,
-    # which is proven to work correctly with the Z-suffixed ISO strings.
+    # /exp takes no bind parameters, so the bounds are re-rendered from parsed
+    # datetimes and never reach the SQL as the caller's raw text.
+    # No ORDER BY: rows come back in designated-timestamp order without a sort.
     sql = f"""
     SELECT amplitude FROM "{_sanitize_table_name(collection)}"
-    WHERE ts BETWEEN '{start}' AND '{end}'
-    ORDER BY ts
+    WHERE ts BETWEEN '{_sql_timestamp(start)}' AND '{_sql_timestamp(end)}'
     LIMIT 20000000;
     """
-    # --- END OF THE FIX ---
     
-    with _get_pg_connection() as conn, conn.cursor() as cur:
-        try:
-            cur.execute(sql)
-            return np.array([row[0] for row in cur.fetchall()], dtype=np.int16)
-        except psycopg2.Error as e:
-            print(f"ERROR: Raw audio query failed: {e}")
-            raise HTTPException(status_code=500, detail="Database query for raw audio failed.")
\ No newline at end of file
+    # Pull the samples as CSV and parse them straight into an int16 array in
+    # pandas' C reader, instead of materializing one Python tuple per sample.
+    try:
+        with _export_csv(sql) as response:
+            df = pd.read_csv(response, usecols=['amplitude'], dtype={'amplitude': np.int16}, engine='c')
+        return df['amplitude'].to_numpy()
+    except pd.errors.EmptyDataError:
+        return np.empty(0, dtype=np.int16)
+    except (urllib.error.URLError, pd.errors.ParserError) as e:
+        print(f"ERROR: Raw audio query failed: {e}")
+        raise HTTPException(status_code=500, detail="Database query for raw audio failed.")
\ No newline at end of file
@@ -5,7 +5,7 @@ Run this from your backend directory.
 """
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import sql
 import os
 from dotenv import load_dotenv
 
@@ -30,7 +30,7 @@ def check_database():
             database=QUESTDB_DATABASE
         )
         
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur = conn.cursor()
         
         print("🔍 QuestDB Database Inspection")
         print("=" * 50)
@@ -42,7 +42,7 @@ def check_database():
             tables = cur.fetchall()
             if tables:
                 for table in tables:
-                    print(f"  - {table['table']}")
+                    print(f"  - {table[0]}")
             else:
                 print("  ❌ No tables found!")
                 return
@@ -51,50 +51,56 @@ def check_database():
             return
         
         # 2. Check each table that looks like audio data
+        # Fetch column metadata for every table in one round-trip
+        cols_by_table = {}
+        cur.execute("SELECT table_name, column_name FROM information_schema.columns")
+        for tbl, col in cur.fetchall():
+            cols_by_table.setdefault(tbl, []).append(col)
+        
         audio_tables = []
         for table in tables:
-            table_name = table['table']
+            table_name = table[0]
             try:
                 # Check if table has audio-like columns
-                cur.execute(f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name = '{table_name}'")
-                columns = cur.fetchall()
-                column_names = [col['column_name'] for col in columns]
+                column_names = cols_by_table.get(table_name, [])
                 
                 if 'amplitude' in column_names and 'ts' in column_names:
                     audio_tables.append(table_name)
                     print(f"\n🎵 Audio Table: {table_name}")
                     print(f"  Columns: {column_names}")
                     
+                    # Table names come from SHOW TABLES; quote them as identifiers
+                    table_ident = sql.Identifier(table_name)
+                    
                     # Count records
-                    cur.execute(f"SELECT COUNT(*) as count FROM {table_name}")
+                    cur.execute(sql.SQL("SELECT COUNT(*) as count FROM {}").format(table_ident))
                     count_result = cur.fetchone()
-                    record_count = count_result['count'] if count_result else 0
+                    record_count = count_result[0] if count_result else 0
                     print(f"  📊 Total records: {record_count:,}")
                     
                     if record_count > 0:
                         # Get time range
-                        cur.execute(f"SELECT min(ts) as start_time, max(ts) as end_time FROM {table_name}")
+                        cur.execute(sql.SQL("SELECT min(ts) as start_time, max(ts) as end_time FROM {}").format(table_ident))
                         time_range = cur.fetchone()
                         if time_range:
-                            print(f"  ⏰ Time range: {time_range['start_time']} to {time_range['end_time']}")
+                            print(f"  ⏰ Time range: {time_range[0]} to {time_range[1]}")
                         
                         # Get sample data
-                        cur.execute(f"SELECT * FROM {table_name} LIMIT 5")
+                        cur.execute(sql.SQL("SELECT ts, amplitude, file FROM {} LIMIT 5").format(table_ident))
                         samples = cur.fetchall()
                         print(f"  📝 Sample data:")
-                        for i, sample in enumerate(samples, 1):
-                            print(f"    {i}: ts={sample['ts']}, amplitude={sample['amplitude']}, file={sample.get('source_file', 'N/A')}")
+                        for i, (ts, amplitude, file) in enumerate(samples, 1):
+                            print(f"    {i}: ts={ts}, amplitude={amplitude}, file={file or 'N/A'}")
                         
                         # Check data around the problematic time
                         print(f"\n🔍 Checking data around 2025-06-23T20:00:00...")
-                        cur.execute(f"""
+                        cur.execute(sql.SQL("""
                             SELECT COUNT(*) as count 
-                            FROM {table_name} 
-                            WHERE ts >= '2025-06-23T20:00:00' 
-                            AND ts <= '2025-06-23T20:00:10'
-                        """)
+                            FROM {} 
+                            WHERE ts IN %s
+                        """).format(table_ident), ('2025-06-23T20:00:00.000000Z;10s',))
                         range_count = cur.fetchone()
-                        print(f"  📊 Records in 10-second window: {range_count['count']:,}")
+                        print(f"  📊 Records in 10-second window: {range_count[0]:,}")
                         
             except Exception as e:
                 print(f"  ❌ Error checking table {table_name}: {e}")
@@ -128,33 +134,34 @@ def test_specific_query():
             database=QUESTDB_DATABASE
         )
         
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur = conn.cursor()
         
         print("\n🧪 Testing Problematic Query")
         print("=" * 50)
         
         # Test the query that was failing
         collection = "my_hardcoded_test"
-        start_dt = "2025-06-23T20:00:00.000000+00:00"
-        end_dt = "2025-06-23T20:00:10.000000+00:00"
+        # QuestDB interval literal: 10 seconds starting at 20:00:00, pruned by partition
+        window = "2025-06-23T20:00:00.000000Z;10s"
         interval_us = 5000  # 5ms intervals
         
-        sql = f"""
+        query = sql.SQL("""
         SELECT 
             ts,
             min(amplitude) as min_val,
             max(amplitude) as max_val
-        FROM {collection}
-        WHERE ts >= '{start_dt}' AND ts < '{end_dt}'
-        SAMPLE BY {interval_us}us
+        FROM {}
+        WHERE ts IN %s
+        SAMPLE BY {}
         ORDER BY ts
-        """
+        """).format(sql.Identifier(collection), sql.SQL(f"{int(interval_us)}us"))
+        params = (window,)
         
         print(f"📝 Query:")
-        print(sql)
+        print(cur.mogrify(query, params).decode())
         print()
         
-        cur.execute(sql)
+        cur.execute(query, params)
         results = cur.fetchall()
         
         print(f"✅ Query executed successfully!")
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Checks that parse_filename_for_timestamp agrees with the original strptime-based parser.
+Run from the repository root: python -m backend.tests.check_filename_timestamps
+"""
+
+import os
+import itertools
+from datetime import datetime, timezone
+
+from backend.questdb_client import parse_filename_for_timestamp
+
+def original_parse(filename):
+    """The parser as it was before the regex fast path, used as the reference."""
+    try:
+        parts = os.path.splitext(filename)[0].split('_')
+        timestamp_str = f"{parts[-2]}_{parts[-1]}"
+        naive_dt = datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
+        return naive_dt.replace(tzinfo=timezone.utc)
+    except (IndexError, ValueError):
+        return None
+
+PREFIXES = ["", "dev_", "REC_", "a_b_", "x.y_", "_", "dev-"]
+STAMPS = [
+    "20250623_200000", "2025623_200000", "2025101_5", "20251323_200000",
+    "20250230_120000", "20250623_246060", "20250623_200060", "20250623200000",
+    "20250623_2000", "2025_06", "abc_def", "",
+]
+SUFFIXES = ["", ".WAV", ".wav", ".", ".tar.gz", ".x_y", "_extra.WAV"]
+
+def check():
+    names = ["".join(parts) for parts in itertools.product(PREFIXES, STAMPS, SUFFIXES)]
+    names += ["20250623_200000", ".20250623_200000", "20250623_200000.WAV"]
+    mismatches = [(n, original_parse(n), parse_filename_for_timestamp(n))
+                  for n in names if original_parse(n) != parse_filename_for_timestamp(n)]
+    for name, expected, got in mismatches:
+        print(f"✗ {name!r}: expected {expected}, got {got}")
+    accepted = sum(original_parse(n) is not None for n in names)
+    print(f"Checked {len(names)} names ({accepted} accepted by the original parser), {len(mismatches)} mismatches")
+    return not mismatches
+
+if __name__ == "__main__":
+    exit(0 if check() else 1)
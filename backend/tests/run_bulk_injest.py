@@ -2,7 +2,6 @@
 import os
 import glob
 import time
-from multiprocessing import Pool, cpu_count
 # Use the correct package import
 from backend import questdb_client
 
@@ -39,36 +38,6 @@ def get_wav_files(folder_path, pattern="*.WAV"):
     
     return wav_files
 
-def process_single_file(file_path, collection_name):
-    """Process a single WAV file and return statistics."""
-    print(f"Processing: {os.path.basename(file_path)}")
-    
-    try:
-        # Prepare tasks for this file
-        tasks_to_run = questdb_client.prepare_ingestion_tasks(file_path, collection_name)
-        
-        if not tasks_to_run:
-            print(f"  No tasks generated for {os.path.basename(file_path)}")
-            return 0, 0
-        
-        # Process tasks with multiprocessing
-        num_processes = max(1, cpu_count() - 1)
-        
-        start_time = time.time()
-        with Pool(processes=num_processes) as pool:
-            results = pool.map(questdb_client.ingest_worker, tasks_to_run)
-        end_time = time.time()
-        
-        total_written = sum(results)
-        duration = end_time - start_time
-        
-        print(f"  ✓ {os.path.basename(file_path)}: {total_written:,} points in {duration:.2f}s")
-        return total_written, duration
-        
-    except Exception as e:
-        print(f"  ✗ Error processing {os.path.basename(file_path)}: {str(e)}")
-        return 0, 0
-
 # This is the standard guard for multiprocessing code.
 if __name__ == "__main__":
     print("--- Starting Bulk WAV Ingestion ---")
@@ -101,19 +70,23 @@ if __name__ == "__main__":
     print("="*50)
     
     overall_start_time = time.time()
+    
+    # One task stream over all files: the next file's chunks start while the last ones are still being written
+    with questdb_client.create_ingest_pool() as pool:
+        written, failed = questdb_client.ingest_files_multiprocess(wav_files, COLLECTION_NAME, pool)
+    
     total_points = 0
-    total_duration = 0
     successful_files = 0
-    
-    for i, file_path in enumerate(wav_files, 1):
-        print(f"\n[{i}/{len(wav_files)}] Processing {os.path.basename(file_path)}...")
-        
-        points_written, file_duration = process_single_file(file_path, COLLECTION_NAME)
-        
-        if points_written > 0:
+    for file_path in wav_files:
+        points_written = written[os.path.basename(file_path)]
+        if os.path.basename(file_path) in failed:
+            print(f"  ✗ {os.path.basename(file_path)}: failed, only {points_written:,} points written")
+        elif points_written > 0:
+            print(f"  ✓ {os.path.basename(file_path)}: {points_written:,} points")
             successful_files += 1
             total_points += points_written
-            total_duration += file_duration
+        else:
+            print(f"  ✗ No samples written for {os.path.basename(file_path)}")
     
     overall_end_time = time.time()
     overall_duration = overall_end_time - overall_start_time
@@ -124,11 +97,10 @@ if __name__ == "__main__":
     print("="*50)
     print(f"Files processed: {successful_files}/{len(wav_files)}")
     print(f"Total points written: {total_points:,}")
-    print(f"Total processing time: {total_duration:.2f}s")
     print(f"Overall elapsed time: {overall_duration:.2f}s")
     
-    if total_duration > 0:
-        avg_rate = total_points / total_duration
+    if overall_duration > 0:
+        avg_rate = total_points / overall_duration
         print(f"Average ingestion rate: {avg_rate:,.0f} points/sec")
     
     if successful_files > 0: